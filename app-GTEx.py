@@ -10,9 +10,10 @@
 # import libraries
 import pandas as pd
 import numpy as np
+import os
 import json
-import itertools
-import umap
+import functools
+import operator
 
 import dash
 import dash_table
@@ -21,6 +22,7 @@ import dash_html_components as html
 import dash_core_components as dcc
 import dash_cytoscape as cyto
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 
 import plotly.express as px
 import plotly.graph_objects as go
@@ -32,6 +34,10 @@ from statsmodels.stats.multitest import fdrcorrection
 
 from igraph import Graph
 
+from numba import njit
+
+from preprocess_data import build_onto_csr
+
 pio.templates.default = "plotly_dark"
 
 W3 = "https://www.w3schools.com/w3css/4/w3.css"
@@ -45,30 +51,53 @@ FA = "https://use.fontawesome.com/releases/v5.12.1/css/all.css"
 #-----------------------------------------------------------------------
 
 
-# load latent space
-z = np.load('data/latent_space_embedding.npy')
+# load UMAP embedding of the full latent space, computed by preprocess_data.py
+if not os.path.exists('data/umap_embedding.npy'):
+    raise FileNotFoundError('data/umap_embedding.npy not found, run python3 preprocess_data.py first')
+umap_embedding = np.load('data/umap_embedding.npy')
 
 # load GTEx annotation
 sample_annot = pd.read_csv('data/sample_annot.csv')
 sample_annot = sample_annot[sample_annot.study == 'GTEx'].reset_index(drop=True)
-sample_annot = sample_annot[sample_annot.tissue != 'unknown']
+sample_annot = sample_annot[sample_annot.tissue != 'unknown'].copy()
+sample_annot['study'] = sample_annot['study'].astype('category')
+sample_annot['tissue'] = sample_annot['tissue'].astype('category')
+
+# rows of the UMAP embedding for every study and tissue combination
+subset_idx = {k: v.to_numpy() for k, v in sample_annot.groupby(['study', 'tissue'], observed=True).groups.items()}
 
 
 # load annotation of ontology terms
 annot = pd.read_csv('data/onto_trimmed_annot.csv', sep=';')
 annot['GO'] = annot[['GO_ID', 'GO_term']].agg(' | '.join, axis=1)
-roots = annot[annot.depth == 0].GO_ID.tolist()
-
-# load precomputed onto term Wang semantic similarities
-wsem_sim = np.load('data/onto_trimmed_wang_sem_sim.npy')
+annot_by_id = annot.set_index('GO_ID').sort_index()
 
-# load data for default display
-umap_default = pd.read_csv('data/default_UMAP_results.csv', sep=';')
+# load precomputed onto term Wang semantic similarities, memory-mapped so that workers share the pages
+wsem_sim = np.load('data/onto_trimmed_wang_sem_sim.npy', mmap_mode='r')
 wilcox_results = pd.read_csv('data/Wilcox_results.csv', sep=';')
 
-# load onto graph
-with open('data/onto_trimmed_graph.json', 'r') as jfile:
-    onto_graph = json.load(jfile)
+# sort Wilcoxon results once per tissue so callbacks only need to slice
+wilcox_sorted = {t: g.sort_values(['rank', 'hits', 'med_stat'], ascending=(True,False,False)).reset_index(drop=True)
+                 for t, g in wilcox_results.groupby('tissue', sort=False)}
+wilcox_ind = {t: g.ind.to_numpy() for t, g in wilcox_sorted.items()}
+
+# load onto graph as CSR arrays over the term indices, written by preprocess_data.py
+onto_files = ['data/onto_trimmed_graph_nodes.npy',
+              'data/onto_trimmed_graph_indptr.npy',
+              'data/onto_trimmed_graph_indices.npy']
+go_ids = None
+if all(os.path.exists(f) for f in onto_files):
+    go_ids = tuple(np.load(onto_files[0]).tolist())
+    onto_indptr = np.load(onto_files[1])
+    onto_indices = np.load(onto_files[2])
+
+# build them from the json if they are missing or do not cover the annotated terms
+if go_ids is None or not set(annot.GO_ID).issubset(go_ids):
+    with open('data/onto_trimmed_graph.json', 'r') as jfile:
+        onto_graph = json.load(jfile)
+    go_ids, onto_indptr, onto_indices = build_onto_csr(onto_graph, annot.GO_ID)
+
+go_idx = {go: i for i, go in enumerate(go_ids)}
 #-----------------------------------------------------------------------
 
 
@@ -78,90 +107,156 @@ with open('data/onto_trimmed_graph.json', 'r') as jfile:
 #-----------------------------------------------------------------------
 # function to create scatter plot from UMAP
 
+@functools.lru_cache(maxsize=32)
+def get_color_map(levels):
+    colors = px.colors.qualitative.Dark24
+    return {level: colors[i % len(colors)] for i, level in enumerate(levels)}
+
 def create_scatter_plot(data, color):
     '''
     Input
-    data: data from the precomputed UMAP
+    data: dict of columns from the precomputed UMAP
     color: the variable by which user wishes to color the plot ('study', 'tissue')
     Output
     fig: the UMAP scatter plot colored by color
     '''
-    fig = px.scatter(
-        data, 
-        x='UMAP 1', 
-        y='UMAP 2',
-        color=data[color],
-        color_discrete_sequence=px.colors.qualitative.Dark24, 
-        labels={'color': color}
-    )   
-
-    fig.update_traces(marker=dict(size=2.5))
-    fig.update_layout({'plot_bgcolor': 'black'})
+    x = np.asarray(data['UMAP 1'])
+    y = np.asarray(data['UMAP 2'])
+    levels = np.asarray(data[color])
+    color_map = get_color_map(tuple(pd.unique(levels)))
+
+    # one WebGL trace per level so the legend is kept
+    fig = go.Figure()
+    for level, level_color in color_map.items():
+        sel = levels == level
+        fig.add_trace(go.Scattergl(
+            x=x[sel],
+            y=y[sel],
+            mode='markers',
+            marker=dict(size=2.5, color=level_color),
+            name=level
+        ))
+
+    fig.update_layout({'plot_bgcolor': 'black'},
+                      xaxis_title='UMAP 1',
+                      yaxis_title='UMAP 2',
+                      legend_title_text=color)
 
     return fig
 
 
+# function to compute UMAP for a subset of samples
+
+@functools.lru_cache(maxsize=32)
+def get_umap_embedding(study, tissue):
+    '''
+    Input
+    study, tissue: sorted tuples of the studies and tissues to include
+    Output
+    embedding: dict of the UMAP coordinates and annotation of the subset
+    '''
+    # subset data based on user input
+    samples_sub = np.sort(np.concatenate([subset_idx[(s, t)] for s in study for t in tissue if (s, t) in subset_idx]))
+    annot_sub = sample_annot.loc[samples_sub]
+
+    # take the subset's coordinates from the UMAP of the full latent space
+    emb = umap_embedding[samples_sub]
+    embedding = {'UMAP 1': emb[:,0].tolist(),
+                 'UMAP 2': emb[:,1].tolist(),
+                 'study': annot_sub['study'].tolist(),
+                 'tissue': annot_sub['tissue'].tolist()}
+
+    return embedding
+
+
 # functions to retrieve common ancestors from list of ontology IDs
 
-def find_all_paths(graph, start, end, path=[]):
-    path = path + [start]
-    if start == end:
-        return [path]
-    if start not in graph:
-        return []
-    paths = []
-    for node in graph[start]:
-        if node not in path:
-            new_paths = find_all_paths(graph, node, end, path)
-            for p in new_paths: 
-                paths.append(p)
-    return paths
-
-def get_ancestors(node, roots, graph):
-    paths = [find_all_paths(graph, node, root, []) for root in roots]
-    paths_filt = [path for path in paths if len(path) > 0]
-    paths_filt = list(itertools.chain.from_iterable(paths_filt))
-    ancestors = {x for l in paths_filt for x in l}
-    return ancestors if len(ancestors) > 0 else {node}
-
-def get_comm_ancestors(leaves, roots, graph):
-    ancestors = [get_ancestors(node, roots, graph) for node in leaves]
-    common_ancestors = set.intersection(*ancestors)
-    return common_ancestors
+@njit(cache=True)
+def get_ancestor_matrix(indptr, indices):
+    '''
+    Input
+    indptr, indices: CSR representation of onto_graph over go_idx
+    Output
+    ancestors: bit-packed matrix (little bit order), bit j of row i is set iff go_ids[j] is reachable from go_ids[i]
+    '''
+    n = indptr.shape[0] - 1
+    ancestors = np.zeros((n, (n + 7) // 8), dtype=np.uint8)
+    stack = np.empty(n, dtype=np.int32)
+    for start in range(n):
+        ancestors[start, start >> 3] |= 1 << (start & 7)
+        stack[0] = start
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            for j in range(indptr[node], indptr[node + 1]):
+                parent = indices[j]
+                if not ancestors[start, parent >> 3] & (1 << (parent & 7)):
+                    ancestors[start, parent >> 3] |= 1 << (parent & 7)
+                    stack[top] = parent
+                    top += 1
+    return ancestors
+
+def decode_mask(mask):
+    terms = set()
+    while mask:
+        low = mask & -mask
+        terms.add(go_ids[low.bit_length() - 1])
+        mask ^= low
+    return terms
+
+def get_comm_ancestors(leaves):
+    # terms outside annotation and ontology only share ancestors with themselves
+    mask = functools.reduce(operator.and_, (ancestor_mask[go_idx[node]] if node in go_idx else 0 for node in leaves))
+    return decode_mask(mask)
+
+
+# precompute ancestor bitmasks, bit i is set iff go_ids[i] is an ancestor of the term
+ancestor_mask = [int.from_bytes(row.tobytes(), 'little') for row in get_ancestor_matrix(onto_indptr, onto_indices)]
 
 
 
 # function to compute cytoscape graph from Wilcoxon results
 
-def get_cytoscape_components(group, wsem_sim):
+def get_cytoscape_components(group, ind, wsem_sim):
     '''
     Input 
     group: the sorted results of the Wilcoxon test for one group
+    ind: the indices of the group's terms in wsem_sim
     wsem_sim: the precomputed Wang semantic similarities
     Output
     nodes + edges: the elements for drawing the graph
     stylesheet: the stylesheet for the group
     '''
 
+    # nothing to cluster for fewer than two terms
+    if group.shape[0] < 2:
+        return [], []
+
     # filter and sort the Wang sem sims to match the sorted terms of the group
-    group_sims = wsem_sim[group.ind.to_numpy(),:]
-    group_sims = group_sims[:,group.ind.to_numpy()]
+    group_sims = wsem_sim[np.ix_(ind, ind)].astype(np.float32, copy=False)
 
-    # apply a threshold and set similarity values below to 0
-    group_sims[group_sims < 0.5] = 0
+    # apply a threshold and keep only the term pairs above it as edges
+    src_ind, tgt_ind = np.triu_indices(len(ind), k=1)
+    sims = group_sims[src_ind, tgt_ind]
+    keep = sims >= 0.5
+    src_ind, tgt_ind, w = src_ind[keep], tgt_ind[keep], sims[keep].tolist()
 
     # create the graph and retrieve coordinates
-    graph = Graph.Weighted_Adjacency(group_sims, mode='undirected', loops=False)
+    graph = Graph(n=len(ind), edges=list(zip(src_ind.tolist(), tgt_ind.tolist())), directed=False)
+    graph.es['weight'] = w
     layout = graph.layout()
     group['x'], group['y'] = np.array(layout.coords).T
 
     # retrieve edge information
-    edge_df = graph.get_edge_dataframe()
-    es = [(group.id.iloc[edge_df.source[i]], group.id.iloc[edge_df.target[i]], edge_df.weight[i]) for i in range(edge_df.shape[0])]
+    ids = group['id'].to_numpy()
+    src = ids[src_ind]
+    tgt = ids[tgt_ind]
 
     # perform community clustering and add community membership to the nodes
     community = graph.community_multilevel()
     group['community'] = community.membership
+    comm_of = dict(zip(ids, community.membership))
 
     # create color mapping for communities
     n_comm = len(np.unique(np.array(community.membership)))
@@ -173,27 +268,29 @@ def get_cytoscape_components(group, wsem_sim):
     group['color'] = [color_map[community.membership[i]] for i in range(group.shape[0])]
 
     # extract community members
-    comm_members = {i: group[group.community == i].id.tolist() for i in group.community.unique()}
+    comm_members = {}
+    for id_, c in comm_of.items():
+        comm_members.setdefault(c, []).append(id_)
     comm_members = {k:v for k,v in comm_members.items() if len(v) > 1}
 
     # get community representatives (members with most genes)
-    representatives = []
-    for vals in comm_members.values():
-        representatives.append(group[group.id.isin(vals)].sort_values('genes', ascending=False).iloc[0,:].id)
-    group['representative'] = np.where(group['id'].isin(representatives), True, False)
+    genes_of = dict(zip(ids, group['genes']))
+    representatives = [max(vals, key=genes_of.get) for vals in comm_members.values()]
+    rep_set = set(representatives)
+    group['representative'] = np.fromiter((i in rep_set for i in ids), dtype=bool, count=len(ids))
 
     # get their common ancestors
-    comm_ancestors = {k: get_comm_ancestors(leaves, roots, onto_graph) for k,leaves in comm_members.items()}
+    comm_ancestors = {k: get_comm_ancestors(leaves) for k,leaves in comm_members.items()}
 
     # get representative labels
     rep_labels = []
     for k, v in comm_ancestors.items():
-        if len(v) == 1:
-            rep_labels.append(annot[annot.GO_ID.isin(v)].GO_term.iloc[0])
-        elif len(v) == 0:
-            rep_labels.append(annot[annot.GO_ID.isin(comm_members[k])].sort_values('genes', ascending=False).iloc[0,:].GO_term)
+        if len(v) == 0:
+            sub = annot_by_id.loc[annot_by_id.index.intersection(comm_members[k])]
+            rep_labels.append(sub.nlargest(1, 'genes').GO_term.iloc[0])
         else:
-            rep_labels.append(annot[annot.GO_ID.isin(v)].sort_values(['depth', 'genes'], ascending=[False, False]).iloc[0,:].GO_term)
+            sub = annot_by_id.loc[annot_by_id.index.intersection(list(v))]
+            rep_labels.append(sub.nlargest(1, ['depth', 'genes']).GO_term.iloc[0])
     
     rep_dict = dict(zip(representatives, rep_labels))
     group['rep_label'] = group['id']
@@ -205,20 +302,29 @@ def get_cytoscape_components(group, wsem_sim):
     group['rep_label_hover'] = group['rep_label_hover'].map(rep_dict2).fillna('None')
 
     # create graph nodes and edges for cytoscape
+    node_cols = zip(ids.tolist(),
+                    group['term'].tolist(),
+                    (np.log(group['genes'].to_numpy() + 2)*10).tolist(),
+                    group['representative'].tolist(),
+                    group['rep_label'].tolist(),
+                    group['rep_label_hover'].tolist(),
+                    (group['x'].to_numpy()*50).tolist(),
+                    (group['y'].to_numpy()*50).tolist(),
+                    community.membership)
     nodes = [{'data': 
-                {'id': group.id.iloc[i], 
-                'label': group.term.iloc[i],
-                'genes': np.log(group.genes.iloc[i] + 2)*10,
-                'representative': group.representative.iloc[i],
-                'rep_label': group.rep_label.iloc[i],
-                'rep_label_hover': group.rep_label_hover.iloc[i]},
-             'position': {'x': group.x.iloc[i]*50, 'y': group.y.iloc[i]*50},
-             'classes': str(group.community.iloc[i]),
+                {'id': id_, 
+                'label': term,
+                'genes': genes,
+                'representative': rep,
+                'rep_label': rep_label,
+                'rep_label_hover': rep_label_hover},
+             'position': {'x': x, 'y': y},
+             'classes': str(c),
              'grabbable': True,
-             'selectable': True} for i in range(group.shape[0])]
+             'selectable': True} for id_, term, genes, rep, rep_label, rep_label_hover, x, y, c in node_cols]
 
-    edges = [{'data': {'source': e[0], 'target': e[1], 'weight': e[2]*5},
-          'classes': str( group[group.id == e[0]].community.iloc[0])} for e in es]
+    edges = [{'data': {'source': s, 'target': t, 'weight': w_*5},
+          'classes': str(comm_of[s])} for s, t, w_ in zip(src, tgt, w)]
 
     # create stylehseet
     stylesheet = [
@@ -262,6 +368,26 @@ def get_cytoscape_components(group, wsem_sim):
     )
 
     return nodes + edges, stylesheet
+
+
+# function to memoize cytoscape graphs per tissue and slider range
+
+@functools.lru_cache(maxsize=256)
+def get_tissue_components(tissue, start, stop):
+    '''
+    Input
+    tissue: the tissue for which to display the top terms
+    start, stop: the range of top terms selected on the slider
+    Output
+    elements, stylesheet: the cytoscape components, as returned by get_cytoscape_components
+    '''
+    # cleared dropdown or tissue without Wilcoxon results
+    if tissue not in wilcox_sorted:
+        return [], []
+
+    data_sig = wilcox_sorted[tissue].iloc[start:stop,:].copy()
+    ind_sig = wilcox_ind[tissue][start:stop]
+    return get_cytoscape_components(data_sig, ind_sig, wsem_sim)
 #-----------------------------------------------------------------------
 
 
@@ -565,34 +691,15 @@ app.layout = html.Div(
 )
 def compute_UMAP(n_clicks, study, tissue):
 
-    # check if the setting is the default
-    default = False
-    if len(study) == 0 and len(tissue) == 0:
-        default=True
-
-    if default == True:
-        embedding = umap_default
-    else:
-        # adjust input for empty fields
-        if len(study) == 0:
-            study = sample_annot.study.unique().tolist()
-        if len(tissue) == 0:
-            tissue = sample_annot.tissue.unique().tolist()
-
-        # subset data based on user input
-        annot_sub = sample_annot[sample_annot.study.isin(study) & sample_annot.tissue.isin(tissue)]
-        samples_sub = annot_sub.index.to_numpy()
-        z_sub = z[samples_sub,:]
+    # adjust input for empty fields, the default setting shows all samples
+    if len(study) == 0:
+        study = sample_annot.study.unique().tolist()
+    if len(tissue) == 0:
+        tissue = sample_annot.tissue.unique().tolist()
 
-        # run UMAP
-        reducer = umap.UMAP()
-        embedding = reducer.fit_transform(z_sub)
-        embedding = pd.DataFrame(embedding)
-        embedding.columns = ['UMAP 1', 'UMAP 2']
+    embedding = get_umap_embedding(tuple(sorted(study)), tuple(sorted(tissue)))
 
-        embedding = pd.concat([embedding, annot_sub.reset_index(drop=True)], axis=1)
-
-    return embedding.to_json(date_format='iso', orient='split')
+    return embedding
 
 
 # Callback for UMAP coloring
@@ -606,10 +713,8 @@ def compute_UMAP(n_clicks, study, tissue):
 )
 def update_scatter_plot(umap_res, color1, color2):
 
-    fig_data = pd.read_json(umap_res, orient='split')
-
-    fig1 = create_scatter_plot(fig_data, color1)
-    fig2 = create_scatter_plot(fig_data, color2)
+    fig1 = create_scatter_plot(umap_res, color1)
+    fig2 = create_scatter_plot(umap_res, color2)
 
     return fig1, fig2
 
@@ -626,10 +731,10 @@ def update_scatter_plot(umap_res, color1, color2):
 )
 def draw_graph1(tissue, values):
 
-    data = wilcox_results[wilcox_results.tissue == tissue]
-    data_sig = data.sort_values(['rank', 'hits', 'med_stat'], ascending = (True,False,False)).iloc[values[0]:values[1],:]
+    if values[0] >= values[1]:
+        raise PreventUpdate
 
-    elements1, stylesheet1 = get_cytoscape_components(data_sig, wsem_sim)
+    elements1, stylesheet1 = get_tissue_components(tissue, values[0], values[1])
 
     return elements1, stylesheet1
 
@@ -641,10 +746,10 @@ def draw_graph1(tissue, values):
 )
 def draw_graph2(tissue, values):
 
-    data = wilcox_results[wilcox_results.tissue == tissue]
-    data_sig = data.sort_values(['rank', 'hits', 'med_stat'], ascending = (True,False,False)).iloc[values[0]:values[1],:]
+    if values[0] >= values[1]:
+        raise PreventUpdate
 
-    elements2, stylesheet2 = get_cytoscape_components(data_sig, wsem_sim)
+    elements2, stylesheet2 = get_tissue_components(tissue, values[0], values[1])
 
     return elements2, stylesheet2
 
@@ -0,0 +1,84 @@
+###========================================================================###
+##                 PREPROCESSING OF DATA FOR THE DASH APP                   ##
+###========================================================================###
+
+# Run once after downloading the data, and again whenever the latent space
+# embedding, the ontology annotation or the ontology graph change:
+#
+#     python3 preprocess_data.py
+
+
+
+### SETTING UP ENVIRONMENT ###
+
+#-----------------------------------------------------------------------
+# import libraries
+import pandas as pd
+import numpy as np
+import json
+import itertools
+#-----------------------------------------------------------------------
+
+
+
+### DEFINING HELPER FUNCTIONS
+
+#-----------------------------------------------------------------------
+# function to fit UMAP on the full latent space
+
+def fit_reducer(z):
+    '''
+    Input
+    z: the latent space embedding of all samples
+    Output
+    reducer: the UMAP reducer fitted on z
+    '''
+    # imported here so that the app can use build_onto_csr without loading umap
+    import umap
+
+    return umap.UMAP(random_state=42, low_memory=True).fit(z)
+
+
+# function to convert the onto graph into CSR arrays
+
+def build_onto_csr(onto_graph, go_terms):
+    '''
+    Input
+    onto_graph: dict mapping each ontology ID to the IDs of its parents
+    go_terms: further ontology IDs to index, e.g. the annotated terms
+    Output
+    go_ids: tuple of all ontology IDs, sorted, a term's index is its bit position
+    indptr, indices: CSR representation of onto_graph over the term indices
+    '''
+    go_ids = tuple(sorted(set(go_terms) | set(onto_graph) | {p for parents in onto_graph.values() for p in parents}))
+    go_idx = {go: i for i, go in enumerate(go_ids)}
+
+    onto_parents = [[go_idx[p] for p in onto_graph.get(go, ())] for go in go_ids]
+    indptr = np.zeros(len(go_ids) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(p) for p in onto_parents])
+    indices = np.fromiter(itertools.chain.from_iterable(onto_parents), dtype=np.int32, count=indptr[-1])
+
+    return go_ids, indptr, indices
+#-----------------------------------------------------------------------
+
+
+
+### WRITING PREPROCESSED DATA
+
+#-----------------------------------------------------------------------
+if __name__ == '__main__':
+
+    # fit UMAP on the full latent space
+    z = np.ascontiguousarray(np.load('data/latent_space_embedding.npy'), dtype=np.float32)
+    np.save('data/umap_embedding.npy', fit_reducer(z).embedding_)
+
+    # convert onto graph into CSR arrays
+    annot = pd.read_csv('data/onto_trimmed_annot.csv', sep=';')
+    with open('data/onto_trimmed_graph.json', 'r') as jfile:
+        onto_graph = json.load(jfile)
+    go_ids, indptr, indices = build_onto_csr(onto_graph, annot.GO_ID)
+
+    np.save('data/onto_trimmed_graph_nodes.npy', np.array(go_ids))
+    np.save('data/onto_trimmed_graph_indptr.npy', indptr)
+    np.save('data/onto_trimmed_graph_indices.npy', indices)
+#-----------------------------------------------------------------------